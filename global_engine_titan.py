@@ -15,11 +15,28 @@ Author: Maxime Perriard
 """
 
 import yfinance as yf
+import yfinance.multi as yf_multi
 import pandas as pd
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import glob
+import hashlib
+import os
+import time
 import warnings
 
+try:
+    from numba import njit, prange
+    import scipy  # noqa: F401 -- numba's np.dot / @ call BLAS through SciPy
+except ImportError:  # numba is optional; fall back to plain Python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda fn: fn
+
+    prange = range
+
 warnings.filterwarnings("ignore")
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -31,6 +48,7 @@ LOOKBACK_MOM = 90
 LOOKBACK_VOL = 30
 TOP_N = 25
 MAX_SECTOR_WEIGHT = 0.35
+CAT_LIMIT = int(MAX_SECTOR_WEIGHT * TOP_N)  # max positions per category
 STOP_LOSS_PCT = -0.07
 REBALANCE_DAY = "Friday"
 
@@ -39,6 +57,13 @@ COMMISSION_RATE = 0.0005
 MIN_COMMISSION = 1.00
 MAX_COMMISSION_PCT = 0.005
 
+# Market data download
+DOWNLOAD_CHUNK = 20
+DOWNLOAD_WORKERS = 16
+DOWNLOAD_RETRIES = 2
+DOWNLOAD_RETRY_WAIT = 2.0  # seconds before each retry pass
+CACHE_DIR = ".cache"
+
 # ══════════════════════════════════════════════════════════════════════════════
 # ASSET UNIVERSE (500+ tickers across 7 categories)
 # ══════════════════════════════════════════════════════════════════════════════
@@ -119,83 +144,225 @@ UNIVERSE = {
 }
 
 CATEGORY_LIST = list(UNIVERSE.keys())
+N_CATEGORIES = len(CATEGORY_LIST)
+
+# Category index per ticker; key order is first appearance in UNIVERSE
+TICKER_TO_CAT_IDX = {}
+for cat_idx, tickers in enumerate(UNIVERSE.values()):
+    for t in tickers:
+        TICKER_TO_CAT_IDX[t] = cat_idx
 
 # ══════════════════════════════════════════════════════════════════════════════
 # DATA DOWNLOAD
 # ══════════════════════════════════════════════════════════════════════════════
 
-ALL_TICKERS = sorted(set(t for cat in UNIVERSE.values() for t in cat))
+ALL_TICKERS = list(TICKER_TO_CAT_IDX)
 START_DATE = (datetime.today() - timedelta(days=365 * 3 + LOOKBACK_MOM + 30)).strftime("%Y-%m-%d")
 END_DATE = datetime.today().strftime("%Y-%m-%d")
 
-print(f"Downloading {len(ALL_TICKERS)} tickers from {START_DATE} to {END_DATE}...")
-raw = yf.download(ALL_TICKERS, start=START_DATE, end=END_DATE, auto_adjust=True, progress=True)
 
-prices = raw["Close"].dropna(axis=1, how="all")
+# Older yfinance releases keep download() results in module-level dicts that
+# every call resets, so chunks may only be fetched concurrently when each call
+# carries its own state
+PARALLEL_DOWNLOAD = hasattr(yf_multi, "_DownloadCtx")
+
+
+def download_close(tickers, start, end):
+    """
+    Fetch adjusted closes in small symbol chunks, on a thread pool when the
+    installed yfinance supports concurrent downloads. Tickers that come back
+    missing or all-NaN are retried up to DOWNLOAD_RETRIES times.
+    Returns the closes of the tickers with data, in input order, the tickers
+    still without data and the number of chunks of which no ticker came back.
+    """
+    chunks = [tickers[k : k + DOWNLOAD_CHUNK] for k in range(0, len(tickers), DOWNLOAD_CHUNK)]
+
+    def fetch(chunk):
+        # Let yfinance thread within a chunk when chunks can't run concurrently
+        raw = yf.download(
+            chunk, start=start, end=end, auto_adjust=True, progress=False, threads=not PARALLEL_DOWNLOAD
+        )
+        if raw is None or raw.empty or "Close" not in raw:
+            return None
+        close = raw["Close"]
+        if isinstance(close, pd.Series):  # single-symbol chunk on older yfinance
+            close = close.to_frame(chunk[0])
+        return close.dropna(axis=1, how="all")
+
+    columns = {}
+    pending = list(tickers)
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS if PARALLEL_DOWNLOAD else 1) as pool:
+        for attempt in range(DOWNLOAD_RETRIES + 1):
+            if attempt:
+                time.sleep(DOWNLOAD_RETRY_WAIT)
+            batch = [pending[k : k + DOWNLOAD_CHUNK] for k in range(0, len(pending), DOWNLOAD_CHUNK)]
+            for close in pool.map(fetch, batch):
+                if close is not None:
+                    columns.update(close.items())
+            pending = [t for t in tickers if t not in columns]
+            if not pending:
+                break
+
+    if not columns:
+        raise RuntimeError("No price data downloaded for any ticker")
+    n_failed = sum(not any(t in columns for t in chunk) for chunk in chunks)
+    close = pd.DataFrame({t: columns[t] for t in tickers if t in columns}).sort_index()
+    return close, pending, n_failed
+
+
+# Re-runs over the same window and universe load from a local Parquet cache
+cache_key = hashlib.sha1((START_DATE + END_DATE + ",".join(ALL_TICKERS)).encode()).hexdigest()[:16]
+cache_path = os.path.join(CACHE_DIR, f"prices_{cache_key}.parquet")
+
+if os.path.exists(cache_path):
+    print(f"Loading cached prices from {cache_path}...")
+    prices = pd.read_parquet(cache_path)
+else:
+    print(f"Downloading {len(ALL_TICKERS)} tickers from {START_DATE} to {END_DATE}...")
+    prices, missing, n_failed = download_close(ALL_TICKERS, START_DATE, END_DATE)
+    if missing:
+        print(f"Dropped {len(missing)} tickers without price data: {', '.join(missing)}")
+
+    # Tickers still empty after the retries are taken as delisted and left out
+    # of the cache. A chunk with no ticker at all points at a failed request
+    # rather than delistings, so that run is not cached.
+    if n_failed:
+        print(f"{n_failed} download chunk(s) came back empty; not caching this run")
+    else:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        prices.to_parquet(cache_path, compression="zstd")
+        # Keys change with the window, so older files would pile up
+        for stale in glob.glob(os.path.join(CACHE_DIR, "prices_*.parquet")):
+            if stale != cache_path:
+                os.remove(stale)
 print(f"Valid tickers after cleanup: {prices.shape[1]}")
 
+# Raw price matrix plus daily log returns for the signal engine, computed once.
+# Returns are taken on forward-filled prices (as pct_change does) so a single
+# exchange holiday does not void a ticker's whole lookback window; non-positive
+# prices yield NaN returns instead of -inf. Returns are taken in float64 and
+# only stored as float32; prices, valuation and running sums stay in float64.
+TICKERS = prices.columns.to_numpy()
+P = prices.to_numpy(dtype=np.float64, copy=False)
+VALID = ~np.isnan(P)  # True where the ticker printed a close that day
+P_ffill = prices.ffill().to_numpy(dtype=np.float64)
+LR = np.diff(np.log(P_ffill, out=np.full_like(P_ffill, np.nan), where=P_ffill > 0), axis=0).astype(np.float32)
+
+# Running sums of returns, squared returns and missing returns along time, so
+# the moments of any lookback window are a difference of two rows
+LR_GAPS = np.vstack([np.zeros((1, LR.shape[1]), dtype=np.int64), np.cumsum(np.isnan(LR), axis=0)])
+LR_SUM = np.vstack([np.zeros((1, LR.shape[1])), np.cumsum(np.nan_to_num(LR), axis=0, dtype=np.float64)])
+LR_SQSUM = np.vstack([np.zeros((1, LR.shape[1])), np.cumsum(np.nan_to_num(LR).astype(np.float64) ** 2, axis=0)])
+
+# Category of each price column as a small int (-1 = not in the universe)
+cat_of_col = np.array([TICKER_TO_CAT_IDX.get(t, -1) for t in TICKERS], dtype=np.int8)
+
 # ══════════════════════════════════════════════════════════════════════════════
 # HELPER FUNCTIONS
 # ══════════════════════════════════════════════════════════════════════════════
 
-TICKER_TO_CATEGORY = {}
-for cat, tickers in UNIVERSE.items():
-    for t in tickers:
-        TICKER_TO_CATEGORY[t] = cat
-
 
+@njit(cache=True)
 def calc_commission(trade_value):
-    """IBKR tiered commission model."""
-    comm = abs(trade_value) * COMMISSION_RATE
-    comm = max(comm, MIN_COMMISSION)
-    comm = min(comm, abs(trade_value) * MAX_COMMISSION_PCT)
-    return comm
+    """IBKR tiered commission model. Accepts a scalar or an array of trades."""
+    notional = np.abs(trade_value)
+    comm = np.maximum(notional * COMMISSION_RATE, MIN_COMMISSION)
+    return np.minimum(comm, notional * MAX_COMMISSION_PCT)
 
 
-def rank_assets(date, prices_df):
+@njit(cache=True)
+def _pick_top_n(order, cat_of_col, cap_count):
     """
-    Rank assets by momentum-to-volatility ratio.
-    Returns top N tickers with target weights respecting sector caps.
+    Walk columns in descending score order and return the first TOP_N that
+    fit under the per-category cap. cap_count is updated in place.
     """
-    loc = prices_df.index.get_loc(date)
-    if loc < LOOKBACK_MOM:
-        return {}
+    picked = np.empty(TOP_N, dtype=np.int64)
+    n_picked = 0
 
-    window_mom = prices_df.iloc[loc - LOOKBACK_MOM : loc + 1]
-    window_vol = prices_df.iloc[loc - LOOKBACK_VOL : loc + 1]
+    for j in order:
+        if n_picked >= TOP_N:
+            break
+        c = cat_of_col[j]
+        if c < 0:
+            continue
+        if cap_count[c] >= CAT_LIMIT:
+            continue
+        picked[n_picked] = j
+        n_picked += 1
+        cap_count[c] += 1
 
-    returns_mom = window_mom.pct_change().dropna()
-    returns_vol = window_vol.pct_change().dropna()
+    return picked[:n_picked]
 
-    momentum = returns_mom.mean()
-    volatility = returns_vol.std()
 
-    valid = volatility[volatility > 0].index.intersection(momentum.index)
-    score = (momentum[valid] / volatility[valid]).dropna().sort_values(ascending=False)
+@njit(cache=True)
+def rank_assets(loc, LR_SUM, LR_SQSUM, LR_GAPS, cat_of_col):
+    """
+    Rank assets by momentum-to-volatility ratio as of row loc.
+    Returns the top N column indices and target weights respecting sector caps.
+    """
+    no_picks = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+    if loc < LOOKBACK_MOM:
+        return no_picks
 
-    # Filter: only positive momentum
-    score = score[score > 0]
+    # Log returns are additive: the window sum is the period's log return
+    momentum = LR_SUM[loc] - LR_SUM[loc - LOOKBACK_MOM]
 
-    selected = {}
-    category_weight = {c: 0.0 for c in CATEGORY_LIST}
+    # Sample variance from the window's sum and sum of squares
+    s = LR_SUM[loc] - LR_SUM[loc - LOOKBACK_VOL]
+    ss = LR_SQSUM[loc] - LR_SQSUM[loc - LOOKBACK_VOL]
+    volatility = np.sqrt(np.maximum(ss - s * s / LOOKBACK_VOL, 0.0) / (LOOKBACK_VOL - 1))
 
-    for ticker in score.index:
-        if len(selected) >= TOP_N:
-            break
-        cat = TICKER_TO_CATEGORY.get(ticker, "Unknown")
-        if cat == "Unknown":
-            continue
-        if category_weight[cat] + (1 / TOP_N) > MAX_SECTOR_WEIGHT:
-            continue
-        selected[ticker] = score[ticker]
-        category_weight[cat] += 1 / TOP_N
+    # Only tickers with a full history over both windows are ranked
+    complete = (LR_GAPS[loc] == LR_GAPS[loc - LOOKBACK_MOM]) & (LR_GAPS[loc] == LR_GAPS[loc - LOOKBACK_VOL])
 
-    if not selected:
-        return {}
+    score = momentum / (volatility * LOOKBACK_MOM)
 
-    total_score = sum(selected.values())
-    weights = {t: s / total_score for t, s in selected.items()}
-    return weights
+    # Filter: only positive momentum
+    ranked = complete & (volatility > 0) & (score > 0)
+    n_pos = np.count_nonzero(ranked)
+    if n_pos == 0:
+        return no_picks
+
+    # Only the head of the ranking matters: partition out the best k
+    # candidates (headroom for sector-cap rejections) and sort just those.
+    # Ordering every ranked column is only needed if the caps exhaust them.
+    cols = np.flatnonzero(ranked)
+    neg = -score[cols]
+    k = TOP_N * 3
+    if n_pos > k:
+        cand = np.argpartition(neg, k)[:k]
+        order = cols[cand[np.argsort(neg[cand])]]
+    else:
+        order = cols[np.argsort(neg)]
+
+    picked = _pick_top_n(order, cat_of_col, np.zeros(N_CATEGORIES, dtype=np.int8))
+    if len(picked) < TOP_N and len(order) < n_pos:
+        order = cols[np.argsort(neg)]
+        picked = _pick_top_n(order, cat_of_col, np.zeros(N_CATEGORIES, dtype=np.int8))
+
+    if len(picked) == 0:
+        return no_picks
+
+    return picked, score[picked] / score[picked].sum()
+
+
+@njit(cache=True, parallel=True)
+def build_target_table(rebal_indices, LR_SUM, LR_SQSUM, LR_GAPS, cat_of_col):
+    """
+    Resolve the picks for every rebalance row up front. Rankings depend only
+    on prices, so the backtest just indexes into the returned
+    (n_rebal, TOP_N) column / weight tables, padded with -1 columns.
+    Rebalances are independent and each fills its own row, so they run in
+    parallel under numba.
+    """
+    n_rebal = len(rebal_indices)
+    target_cols = np.full((n_rebal, TOP_N), -1, dtype=np.int32)
+    target_w = np.zeros((n_rebal, TOP_N), dtype=np.float64)
+    for k in prange(n_rebal):
+        cols, weights = rank_assets(rebal_indices[k], LR_SUM, LR_SQSUM, LR_GAPS, cat_of_col)
+        target_cols[k, : len(cols)] = cols
+        target_w[k, : len(weights)] = weights
+    return target_cols, target_w
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -204,103 +371,131 @@ def rank_assets(date, prices_df):
 
 print("\nRunning backtest...")
 
-portfolio_value = [INITIAL_CAPITAL]
-dates_track = [prices.index[LOOKBACK_MOM]]
-holdings = {}
-cash = INITIAL_CAPITAL
-total_commissions = 0.0
-
-rebalance_dates = prices.index[prices.index.dayofweek == 4]  # Fridays
 
-for i, date in enumerate(prices.index[LOOKBACK_MOM:], start=LOOKBACK_MOM):
-    current_prices = prices.loc[date]
-
-    # ── STOP-LOSS CHECK ──
-    stopped_out = []
-    for ticker, qty in list(holdings.items()):
-        if ticker not in current_prices or pd.isna(current_prices[ticker]):
-            continue
-        entry_price = holdings[ticker]
-        current_price = current_prices[ticker]
-        if isinstance(entry_price, dict):
-            entry_p = entry_price["entry_price"]
-            qty_held = entry_price["qty"]
-        else:
-            continue
-
-        ret = (current_price - entry_p) / entry_p
-        if ret <= STOP_LOSS_PCT:
-            sell_value = qty_held * current_price
-            comm = calc_commission(sell_value)
-            cash += sell_value - comm
-            total_commissions += comm
-            stopped_out.append(ticker)
-
-    for t in stopped_out:
-        del holdings[t]
+@njit(cache=True)
+def _backtest_loop(P, P_ffill, VALID, rebal_indices, target_cols, target_w, start, initial_capital):
+    """
+    Event-driven accounting over the price matrix. Holdings only change on
+    rebalance days and stop-outs, so the days in between are valued with one
+    matrix-vector product. Row k of target_cols / target_w holds the picks
+    for rebal_indices[k], padded with -1 columns. Positions are marked at the
+    last available close (P_ffill) but only bought on a fresh print.
+    Returns daily portfolio values, total commissions and open positions.
+    """
+    n_days = P.shape[0]
+    n_rebal = len(rebal_indices)
+    portfolio_value = np.empty(n_days - start + 1)
+    portfolio_value[0] = initial_capital
+    cash = float(initial_capital)
+    total_commissions = 0.0
+
+    # Holdings as parallel arrays: column in P, share count, entry price
+    held_col_idx = np.empty(0, dtype=np.int32)
+    held_qty = np.empty(0, dtype=np.float64)
+    held_entry = np.empty(0, dtype=np.float64)
+
+    i = start
+    for k in range(n_rebal + 1):
+        # Segment of static holdings; a rebalance day closes it after its
+        # own stop-loss check
+        rebal_day = rebal_indices[k] if k < n_rebal else n_days
+        seg_stop = min(rebal_day + 1, n_days)
+
+        while i < seg_stop:
+            # ── STOP-LOSS CHECK ──
+            block = P_ffill[i:seg_stop, held_col_idx]
+            hit = (block - held_entry) / held_entry <= STOP_LOSS_PCT
+            hit_days = np.flatnonzero(hit.sum(axis=1))
+            t = i + hit_days[0] if len(hit_days) > 0 else seg_stop
+
+            # ── PORTFOLIO VALUATION ── up to the first stop-out or rebalance
+            quiet_end = min(t, rebal_day)
+            if quiet_end > i:
+                values = P_ffill[i:quiet_end, held_col_idx] @ held_qty
+                portfolio_value[i - start + 1 : quiet_end - start + 1] = values + cash
+            if t == seg_stop:
+                i = seg_stop
+                break
+
+            stopped = hit[t - i]
+            sell_values = held_qty[stopped] * P_ffill[t, held_col_idx[stopped]]
+            comms = calc_commission(sell_values)
+            cash += sell_values.sum() - comms.sum()
+            total_commissions += comms.sum()
+            keep = ~stopped
+            held_col_idx, held_qty, held_entry = held_col_idx[keep], held_qty[keep], held_entry[keep]
+
+            if t < rebal_day:
+                portfolio_value[t - start + 1] = P_ffill[t, held_col_idx] @ held_qty + cash
+            i = t + 1
+
+        if k == n_rebal:
+            break
 
-    # ── REBALANCE ON FRIDAYS ──
-    if date in rebalance_dates:
-        target_weights = rank_assets(date, prices)
+        # ── REBALANCE ON FRIDAYS ──
+        i = rebal_day
+        cols = target_cols[k]
+        n_targets = np.count_nonzero(cols >= 0)
 
-        if target_weights:
+        if n_targets > 0:
             # Sell everything first
-            for ticker, info in list(holdings.items()):
-                if ticker in current_prices and not pd.isna(current_prices[ticker]):
-                    sell_value = info["qty"] * current_prices[ticker]
-                    comm = calc_commission(sell_value)
-                    cash += sell_value - comm
-                    total_commissions += comm
-            holdings = {}
-
-            # Buy new positions
-            total_equity = cash
-            for ticker, weight in target_weights.items():
-                if ticker not in current_prices or pd.isna(current_prices[ticker]):
-                    continue
-                alloc = total_equity * weight
-                price = current_prices[ticker]
-                qty = int(alloc // price)
-                if qty > 0:
-                    cost = qty * price
-                    comm = calc_commission(cost)
-                    cash -= cost + comm
-                    total_commissions += comm
-                    holdings[ticker] = {"qty": qty, "entry_price": price}
-
-    # ── PORTFOLIO VALUATION ──
-    holdings_value = 0
-    for ticker, info in holdings.items():
-        if ticker in current_prices and not pd.isna(current_prices[ticker]):
-            holdings_value += info["qty"] * current_prices[ticker]
-
-    portfolio_value.append(cash + holdings_value)
-    dates_track.append(date)
+            sell_values = held_qty * P_ffill[i, held_col_idx]
+            comms = calc_commission(sell_values)
+            cash += sell_values.sum() - comms.sum()
+            total_commissions += comms.sum()
+
+            # Buy new positions (only tickers quoted today)
+            cols = cols[:n_targets]
+            quoted = VALID[i, cols]
+            cols = cols[quoted]
+            price = P[i, cols]
+            qty = np.floor_divide(cash * target_w[k, :n_targets][quoted], price)
+            buy = qty > 0
+            held_col_idx, held_qty, held_entry = cols[buy], qty[buy], price[buy]
+            costs = held_qty * held_entry
+            comms = calc_commission(costs)
+            cash -= costs.sum() + comms.sum()
+            total_commissions += comms.sum()
+
+        portfolio_value[i - start + 1] = P_ffill[i, held_col_idx] @ held_qty + cash
+        i += 1
+
+    return portfolio_value, total_commissions, len(held_col_idx)
+
+
+is_rebalance = prices.index.dayofweek == 4  # Fridays
+rebal_indices = np.flatnonzero(is_rebalance & (np.arange(len(prices)) >= LOOKBACK_MOM))
+target_cols, target_w = build_target_table(rebal_indices, LR_SUM, LR_SQSUM, LR_GAPS, cat_of_col)
+
+portfolio_value, total_commissions, n_held = _backtest_loop(
+    P, P_ffill, VALID, rebal_indices, target_cols, target_w, LOOKBACK_MOM, INITIAL_CAPITAL
+)
+dates_track = prices.index[[LOOKBACK_MOM]].append(prices.index[LOOKBACK_MOM:])
 
 # ══════════════════════════════════════════════════════════════════════════════
 # PERFORMANCE METRICS
 # ══════════════════════════════════════════════════════════════════════════════
 
-pv = pd.Series(portfolio_value, index=dates_track)
-daily_returns = pv.pct_change().dropna()
+pv = np.asarray(portfolio_value, dtype=np.float64)
+daily_returns = np.diff(pv) / pv[:-1]
 
-total_return = (pv.iloc[-1] / pv.iloc[0]) - 1
+total_return = (pv[-1] / pv[0]) - 1
 ann_return = (1 + total_return) ** (252 / len(daily_returns)) - 1
-ann_vol = daily_returns.std() * np.sqrt(252)
+ann_vol = daily_returns.std(ddof=1) * np.sqrt(252)
 sharpe = ann_return / ann_vol if ann_vol > 0 else 0
-max_dd = ((pv / pv.cummax()) - 1).min()
+max_dd = ((pv / np.maximum.accumulate(pv)) - 1).min()
 
 print("\n" + "=" * 60)
 print("GLOBAL TITAN ENGINE — PERFORMANCE SUMMARY")
 print("=" * 60)
 print(f"Period:              {dates_track[0].strftime('%Y-%m-%d')} → {dates_track[-1].strftime('%Y-%m-%d')}")
 print(f"Initial Capital:     ${INITIAL_CAPITAL:,.0f}")
-print(f"Final Value:         ${pv.iloc[-1]:,.0f}")
+print(f"Final Value:         ${pv[-1]:,.0f}")
 print(f"Total Return:        {total_return:.2%}")
 print(f"Annualized Return:   {ann_return:.2%}")
 print(f"Annualized Vol:      {ann_vol:.2%}")
 print(f"Sharpe Ratio:        {sharpe:.2f}")
 print(f"Max Drawdown:        {max_dd:.2%}")
 print(f"Total Commissions:   ${total_commissions:,.2f}")
-print(f"Active Holdings:     {len(holdings)}")
+print(f"Active Holdings:     {n_held}")
 print("=" * 60)